@@ -51,10 +51,22 @@ class BadRequest(CardboardException):
     """
     pass
 
+class TokenExchangeError(CardboardException):
+    """
+    Exception raised when exchanging an initial code for a token fails.
+
+    Attributes:
+        status (int): The HTTP status code returned by the API.
+    """
+    def __init__(self, status:int):
+        self.status:int = status
+        super().__init__(f"Token exchange failed with status {status}.")
+
 
 CardboardForbidden = Forbidden
 CardboardUnauthorized = Unauthorized
 CardboardNotFound = NotFound
 CardboardInternalServerError = InternalServerError
 CardboardRateLimited = RateLimited
-CardboardBadRequest = BadRequest
\ No newline at end of file
+CardboardBadRequest = BadRequest
+CardboardTokenExchangeError = TokenExchangeError
\ No newline at end of file
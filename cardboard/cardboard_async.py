@@ -195,6 +195,8 @@ class CardboardAsync:
             expires_in (int): How many seconds your new token will last.
             _raw (dict): The raw response from the API.
         """
+        __slots__ = ("token", "refresh_token", "token_type", "expires_in", "_raw")
+
         def __init__(self, data):
             self.token:str = data["access_token"]
             self.refresh_token:str = data["refresh_token"]
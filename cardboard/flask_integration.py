@@ -1,9 +1,13 @@
 from flask import request, Flask, redirect, session
 from functools import wraps
 from cardboard import Cardboard, CardboardAsync
-import aiohttp, asyncio, time, warnings
+from cardboard.Exceptions import CardboardException, TokenExchangeError
+from types import MappingProxyType
+import aiohttp, asyncio, atexit, logging, os, threading, time, warnings
 import concurrent.futures
 
+logger = logging.getLogger(__name__)
+
 class FlaskIntegration:
     """
     A flask integration for Cardboard.
@@ -17,31 +21,170 @@ class FlaskIntegration:
             - expiry (eg. "cardboard_expiry")
             - rd (eg. "cardboard_rd")
         - login_url: A custom login URL instead of your Cardboard app's default URL.
+        - trust_local_expiry_window: Opt-in. Tokens whose session expiry is more than this many seconds away are trusted without asking the API. Defaults to None (always check).
+            - WARNING: while enabled, revoked or logged-out tokens (eg. a copied session cookie) stay accepted until the session expiry.
     """
-    def __init__(self, app:Flask, cardboard:Cardboard|CardboardAsync, session_prefix:str="cardboard_", login_url:str=None):
+    __slots__ = (
+        "app", "cb", "cbsync", "secret", "client_id",
+        "session_token", "session_refresh", "session_expiry", "session_rd", "app_login_redirect",
+        "trust_local_expiry_window",
+        "_token_cache", "_token_cache_ttl", "_token_lock", "_inflight",
+        "_aiohttp_session", "_bg_timeout", "_bg_lock", "_bg_pid", "_bg_loop", "_bg_thread",
+        "_token_url", "_form_headers", "_token_data_base", "_refresh_data_base", "_revoke_url", "_revoke_data_base",
+        "__weakref__",
+    )
+
+    def __init__(self, app:Flask, cardboard:Cardboard|CardboardAsync, session_prefix:str="cardboard_", login_url:str=None, trust_local_expiry_window:int|None=None):
+        if not app.secret_key:
+            raise ValueError("Flask app secret key is not set or is empty.")
+
         self.app:Flask = app
-        self.cb:Cardboard|CardboardAsync = cardboard
-        self.secret = self.cb.secret
-        self.client_id = self.cb.client_id
-        self.cb = CardboardAsync(client_id=self.client_id, secret=self.secret)
-        self.cbsync = concurrent.futures.ThreadPoolExecutor().submit(lambda: Cardboard(client_id=self.client_id, secret=self.secret)).result()
+        self.trust_local_expiry_window = trust_local_expiry_window
+        self.secret = cardboard.secret
+        self.client_id = cardboard.client_id
+        self.cb:CardboardAsync = cardboard if isinstance(cardboard, CardboardAsync) else CardboardAsync(client_id=self.client_id, secret=self.secret)
+        self.cbsync:Cardboard = cardboard if isinstance(cardboard, Cardboard) else Cardboard(client_id=self.client_id, secret=self.secret)
         self.session_token = f"{session_prefix}token"
         self.session_refresh = f"{session_prefix}refresh"
         self.session_expiry = f"{session_prefix}expiry"
         self.session_rd = f"{session_prefix}rd"
 
+        self._token_cache:dict[str, float] = {}
+        self._token_cache_ttl:int = 60
+        self._token_lock = threading.Lock()
+        self._inflight:dict[str, concurrent.futures.Future] = {}
+        self._aiohttp_session:aiohttp.ClientSession|None = None
+        self._bg_timeout:int = 30
+        self._bg_lock = threading.Lock()
+        self._bg_pid:int|None = None
+        self._bg_loop:asyncio.AbstractEventLoop|None = None
+        self._bg_thread:threading.Thread|None = None
+
         self.app_login_redirect = self.cb.app_url if not login_url else login_url
 
-        if not app.secret_key:
-            raise ValueError("Flask app secret key is not set or is empty.")
+        self._token_url:str = f"{self.cb._baseurl}/token"
+        self._form_headers = MappingProxyType({"Content-Type": "application/x-www-form-urlencoded"})
+        self._token_data_base = MappingProxyType({
+            "client_id": self.client_id,
+            "client_secret": self.secret,
+            "grant_type": "authorization_code",
+        })
+        self._refresh_data_base = MappingProxyType({
+            "client_id": self.client_id,
+            "client_secret": self.secret,
+            "grant_type": "refresh_token",
+        })
+        self._revoke_url:str = f"{self.cb._baseurl}/token/revoke"
+        self._revoke_data_base = MappingProxyType({
+            "client_id": self.client_id,
+            "client_secret": self.secret,
+        })
+
+        atexit.register(self.close)
     
     def _constructAuthToken(self, token, expiry, refresh):
         """
         Constructs an AuthToken class.
         """
-        data = {"access_token": token, "refresh_token": refresh, "expires_in": expiry-round(time.time()), "token_type": "Bearer"}
+        now = int(time.time())
+        data = {"access_token": token, "refresh_token": refresh, "expires_in": expiry-now, "token_type": "Bearer"}
         return self.cb.AuthToken(data=data)
 
+    def _check_token_cached(self, token:str, expiry:int=None) -> bool:
+        """
+        Checks whether a token is valid, caching valid results for a short time.
+
+        Concurrent checks for the same token share a single API call.
+
+        A token whose session expiry has already passed is invalid without asking the API,
+        and one that is further than trust_local_expiry_window from expiring is valid without asking.
+        """
+        now = time.time()
+        if expiry is not None:
+            if expiry <= now:
+                return False
+            if self.trust_local_expiry_window is not None and expiry - now > self.trust_local_expiry_window:
+                return True
+        if self._token_cache.get(token, 0) > now:
+            return True
+        with self._token_lock:
+            future = self._inflight.get(token)
+            owner = future is None
+            if owner:
+                future = concurrent.futures.Future()
+                self._inflight[token] = future
+        if not owner:
+            return future.result()
+        try:
+            valid = bool(self.cbsync.check_token(token))
+        except Exception as e:
+            with self._token_lock:
+                self._inflight.pop(token, None)
+            future.set_exception(e)
+            raise
+        with self._token_lock:
+            if valid:
+                if len(self._token_cache) > 1024:
+                    for key in [key for key, valid_until in self._token_cache.items() if valid_until <= now]:
+                        self._token_cache.pop(key, None)
+                self._token_cache[token] = now + self._token_cache_ttl
+            else:
+                self._token_cache.pop(token, None)
+            self._inflight.pop(token, None)
+        future.set_result(valid)
+        return valid
+
+    def _return_path(self) -> str:
+        """
+        Returns the current request's URL relative to the host, keeping its percent-encoding.
+        """
+        return request.url[len(request.host_url) - 1:]
+
+    def _log_revoke_error(self, future:concurrent.futures.Future):
+        """
+        Logs a failed background token revocation.
+        """
+        if future.cancelled():
+            logger.warning("Cardboard token revocation was cancelled.")
+        elif future.exception() is not None:
+            logger.warning("Failed to revoke Cardboard token: %r", future.exception())
+
+    def _get_loop(self) -> asyncio.AbstractEventLoop:
+        """
+        Returns the background event loop, starting it on first use in each process.
+
+        Forked workers (eg. uWSGI, gunicorn --preload) don't inherit the loop thread, so they get their own loop and aiohttp session.
+        """
+        pid = os.getpid()
+        if self._bg_pid != pid:
+            with self._bg_lock:
+                if self._bg_pid != pid:
+                    self._aiohttp_session = None
+                    self._bg_loop = asyncio.new_event_loop()
+                    self._bg_thread = threading.Thread(target=self._bg_loop.run_forever, name="cardboard-flask-loop", daemon=True)
+                    self._bg_thread.start()
+                    self._bg_pid = pid
+        return self._bg_loop
+
+    def _run(self, coro):
+        """
+        Runs a coroutine on the background event loop and waits for its result.
+
+        The coroutine is cancelled if it doesn't finish within the timeout.
+        """
+        future = asyncio.run_coroutine_threadsafe(coro, self._get_loop())
+        try:
+            return future.result(timeout=self._bg_timeout)
+        except concurrent.futures.TimeoutError:
+            future.cancel()
+            raise
+
+    async def _arun(self, coro):
+        """
+        Runs a coroutine on the background event loop and awaits its result from another loop.
+        """
+        return await asyncio.wait_for(asyncio.wrap_future(asyncio.run_coroutine_threadsafe(coro, self._get_loop())), timeout=self._bg_timeout)
+
     def getloop(self):
         try:
             loop = asyncio.get_event_loop()
@@ -50,14 +193,87 @@ class FlaskIntegration:
             asyncio.set_event_loop(loop)
         return loop
 
-    async def asyncpost(self, url, data=None, headers=None) -> dict|int:
+    async def _get_session(self) -> aiohttp.ClientSession:
         """
-        Makes a post request. Returns json or int.
+        Returns the shared aiohttp session, creating it if needed. Must be called on the background loop.
         """
-        async with aiohttp.ClientSession() as cs:
-            async with cs.post(url, data=data, headers=headers) as response:
-                return await response.json() if response.status == 200 else response.status
+        if self._aiohttp_session is None or self._aiohttp_session.closed:
+            self._aiohttp_session = aiohttp.ClientSession(connector=aiohttp.TCPConnector(
+                limit=100,
+                limit_per_host=32,
+                use_dns_cache=True,
+                ttl_dns_cache=600,
+                keepalive_timeout=75,
+                force_close=False,
+                # Only needed on Pythons with the SSL transport leak; newer aiohttp warns otherwise.
+                enable_cleanup_closed=getattr(aiohttp.connector, "NEEDS_CLEANUP_CLOSED", True),
+            ), read_bufsize=16384)
+        return self._aiohttp_session
+
+    async def aclose(self):
+        """
+        Closes the shared aiohttp session.
+        """
+        if self._aiohttp_session is not None and not self._aiohttp_session.closed:
+            await self._aiohttp_session.close()
+
+    def close(self):
+        """
+        Closes the shared aiohttp session, then stops the background event loop.
+
+        Called automatically on interpreter exit. The integration can't be used after this.
+        """
+        atexit.unregister(self.close)
+        if self._bg_pid != os.getpid() or self._bg_loop.is_closed():
+            return
+        try:
+            self._run(self.aclose())
+        except:
+            pass
+        self._bg_loop.call_soon_threadsafe(self._bg_loop.stop)
+        self._bg_thread.join()
+        self._bg_loop.close()
+
+    async def asyncpost(self, url, data=None, headers=None) -> dict:
+        """
+        Makes a post request. Returns json, or raises TokenExchangeError if the status is not 200.
+
+        Always runs on the background loop, since the shared aiohttp session is bound to it.
+        """
+        if asyncio.get_running_loop() is not self._bg_loop:
+            return await self._arun(self.asyncpost(url, data=data, headers=headers))
+        cs = await self._get_session()
+        async with cs.post(url, data=data, headers=headers) as response:
+            if response.status != 200:
+                response.release()
+                raise TokenExchangeError(response.status)
+            return await response.json()
     
+    async def _refresh_token(self, refresh:str):
+        """
+        Refreshes an authorization token through the shared aiohttp session. Returns an AuthToken class.
+        """
+        data = {**self._refresh_data_base, "refresh_token": refresh}
+        return self.cb.AuthToken(await self.asyncpost(self._token_url, data=data, headers=self._form_headers))
+
+    async def _revoke_token(self, token:str):
+        """
+        Revokes an authorization token through the shared aiohttp session.
+        """
+        data = {**self._revoke_data_base, "token": token}
+        cs = await self._get_session()
+        async with cs.post(self._revoke_url, data=data, headers=self._form_headers) as response:
+            if response.status != 200:
+                response.release()
+                raise CardboardException(f"Token revocation failed with status {response.status}.")
+
+    def _revoke_in_background(self, token:str):
+        """
+        Starts revoking a token on the background loop without waiting for it. Failures are logged.
+        """
+        coro = asyncio.wait_for(self._revoke_token(token), timeout=self._bg_timeout)
+        asyncio.run_coroutine_threadsafe(coro, self._get_loop()).add_done_callback(self._log_revoke_error)
+
     def autologin(self, route_function):
         """
         Automatically logs you in with a token, or else redirects you to the app login page. This is async.
@@ -74,47 +290,57 @@ class FlaskIntegration:
                 # run code, with token always valid.
             ```
         """
+        session_token = self.session_token
+        session_expiry = self.session_expiry
+        session_refresh = self.session_refresh
+        session_rd = self.session_rd
+        app_login_redirect = self.app_login_redirect
+        check = self._check_token_cached
+        construct = self._constructAuthToken
+        run = self._run
+        asyncpost = self.asyncpost
+        token_url = self._token_url
+        form_headers = self._form_headers
+        token_data_base = self._token_data_base
+        refresh_token = self._refresh_token
+        cb = self.cb
         @wraps(route_function)
         def decorator(*args, **kwargs):
             code = request.args.get('code')
-            thetoken = session.get(self.session_token)
-            if thetoken and concurrent.futures.ThreadPoolExecutor().submit(lambda: self.cbsync.check_token(thetoken)).result():
+            thetoken = session.get(session_token)
+            expiry = session.get(session_expiry)
+            if thetoken and check(thetoken, expiry):
                 token = thetoken
-                if session.get(self.session_expiry) and session.get(self.session_refresh):
-                    token = self._constructAuthToken(token, session.get(self.session_expiry), session.get(self.session_refresh))
-                elif session.get(self.session_refresh):
-                    loop = self.getloop()
+                refresh = session.get(session_refresh)
+                if expiry and refresh:
+                    token = construct(token, expiry, refresh)
+                elif refresh:
                     try:
-                        token = loop.run_until_complete(self.cb.refresh_token(session.get(self.session_refresh)))
+                        token = run(refresh_token(refresh))
                     except:
-                        return redirect(self.app_login_redirect)
+                        return redirect(app_login_redirect)
                 result = route_function(token, *args, **kwargs)
-                if session.get(self.session_rd):
-                    a = session.pop(self.session_rd)
-                    return redirect(a)
+                rd = session.pop(session_rd, None)
+                if rd:
+                    return redirect(rd)
                 return result
             if code:
-                grant_type = "authorization_code"
-                data = {
-                    "code": code,
-                    "client_id": self.client_id,
-                    "client_secret": self.secret,
-                    "grant_type": grant_type,
-                }
-                loop = self.getloop()
-                response = loop.run_until_complete(self.asyncpost(f"{self.cb._baseurl}/token", data=data, headers={"Content-Type": "application/x-www-form-urlencoded"}))
-                if type(response) == int:
-                    return redirect(self.app_login_redirect)
-                token = self.cb.AuthToken(response)
+                data = {**token_data_base, "code": code}
+                try:
+                    response = run(asyncpost(token_url, data=data, headers=form_headers))
+                except (TokenExchangeError, concurrent.futures.TimeoutError):
+                    return redirect(app_login_redirect)
+                token = cb.AuthToken(response)
             else:
-                return redirect(self.app_login_redirect)
-            session[self.session_token] = token.token
-            session[self.session_expiry] = round(time.time())+token.expires_in
-            session[self.session_refresh] = token.refresh_token
+                return redirect(app_login_redirect)
+            now = int(time.time())
+            session[session_token] = token.token
+            session[session_expiry] = now+token.expires_in
+            session[session_refresh] = token.refresh_token
             result = route_function(token, *args, **kwargs)
-            if session.get(self.session_rd):
-                a = session.pop(self.session_rd)
-                return redirect(a)
+            rd = session.pop(session_rd, None)
+            if rd:
+                return redirect(rd)
             return result
         return decorator
 
@@ -138,15 +364,20 @@ class FlaskIntegration:
                 # your login function.
             ```
         """
+        session_token = self.session_token
+        session_expiry = self.session_expiry
+        app_login_redirect = self.app_login_redirect
+        check = self._check_token_cached
         warnings.warn("Deprecated decorator. Please use the autologin decorator instead.", DeprecationWarning)
         @wraps(route_function)
         def decorator(*args, **kwargs):
-            thetoken = session.get(self.session_token)
-            if thetoken and concurrent.futures.ThreadPoolExecutor().submit(lambda: self.cbsync.check_token(thetoken)).result():
+            thetoken = session.get(session_token)
+            expiry = session.get(session_expiry)
+            if thetoken and check(thetoken, expiry):
                 return route_function(None, *args, **kwargs)
             code = request.args.get('code')
             if not code:
-                return redirect(self.app_login_redirect)
+                return redirect(app_login_redirect)
             return route_function(code, *args, **kwargs)
         return decorator
     
@@ -168,28 +399,31 @@ class FlaskIntegration:
                 # your login function.
             ```
         """
+        session_token = self.session_token
+        session_expiry = self.session_expiry
+        check = self._check_token_cached
+        run = self._run
+        asyncpost = self.asyncpost
+        token_url = self._token_url
+        form_headers = self._form_headers
+        token_data_base = self._token_data_base
+        cb = self.cb
         warnings.warn("Deprecated decorator. Please use the autologin decorator instead.", DeprecationWarning)
         @wraps(route_function)
         def decorator(*args, **kwargs):
             code = request.args.get('code')
-            thetoken = session.get(self.session_token)
-            if thetoken and concurrent.futures.ThreadPoolExecutor().submit(lambda: self.cbsync.check_token(thetoken)).result():
+            thetoken = session.get(session_token)
+            expiry = session.get(session_expiry)
+            if thetoken and check(thetoken, expiry):
                 token = thetoken
                 return route_function(token, *args, **kwargs)
             if code:
-                grant_type = "authorization_code"
-                data = {
-                    "code": code,
-                    "client_id": self.client_id,
-                    "client_secret": self.secret,
-                    "grant_type": grant_type,
-                }
-                loop = self.getloop()
-                response = loop.run_until_complete(self.asyncpost(f"{self.cb._baseurl}/token", data=data, headers={"Content-Type": "application/x-www-form-urlencoded"}))
-                if type(response) == int:
+                data = {**token_data_base, "code": code}
+                try:
+                    response = run(asyncpost(token_url, data=data, headers=form_headers))
+                    token = cb.AuthToken(response)
+                except (TokenExchangeError, concurrent.futures.TimeoutError):
                     token = None
-                else:
-                    token = self.cb.AuthToken(response)
             else:
                 token = None
             return route_function(token, *args, **kwargs)
@@ -200,8 +434,6 @@ class FlaskIntegration:
         Checks if the user is logged in with a valid auth token. Redirects to the app login if not valid.
 
         After logging in, the user is redirected back to the original URL if the @autologin route is used.
-        
-        Checking is done in a seperate thread.
 
         Usage:
 
@@ -211,24 +443,79 @@ class FlaskIntegration:
                 # your function
             ```
         """
+        session_token = self.session_token
+        session_expiry = self.session_expiry
+        session_refresh = self.session_refresh
+        session_rd = self.session_rd
+        app_login_redirect = self.app_login_redirect
+        check = self._check_token_cached
+        construct = self._constructAuthToken
+        run = self._run
+        return_path = self._return_path
+        refresh_token = self._refresh_token
         @wraps(route_function)
         def decorator(*args, **kwargs):
-            thetoken = session.get(self.session_token)
-            if thetoken and concurrent.futures.ThreadPoolExecutor().submit(lambda: self.cbsync.check_token(thetoken)).result():
-                token = session.get(self.session_token)
-                if session.get(self.session_expiry) and session.get(self.session_refresh):
-                    token = self._constructAuthToken(token, session.get(self.session_expiry), session.get(self.session_refresh))
-                elif session.get(self.session_refresh):
-                    loop = self.getloop()
+            thetoken = session.get(session_token)
+            expiry = session.get(session_expiry)
+            if thetoken and check(thetoken, expiry):
+                token = thetoken
+                refresh = session.get(session_refresh)
+                if expiry and refresh:
+                    token = construct(token, expiry, refresh)
+                elif refresh:
                     try:
-                        token = loop.run_until_complete(self.cb.refresh_token(session.get(self.session_refresh)))
+                        token = run(refresh_token(refresh))
                     except:
-                        session[self.session_rd] = request.url
-                        return redirect(self.app_login_redirect)
+                        session[session_rd] = return_path()
+                        return redirect(app_login_redirect)
                 return route_function(token, *args, **kwargs)
             else:
-                session[self.session_rd] = request.url
-                return redirect(self.app_login_redirect)
+                session[session_rd] = return_path()
+                return redirect(app_login_redirect)
+        return decorator
+    
+    def async_logged_in(self, route_function):
+        """
+        Async version of logged_in for async views. Requires flask[async].
+
+        Redirects to the app login if not valid, same as logged_in.
+
+        Usage:
+
+            ```@app.route('/dashboard')
+            @fi.async_logged_in
+            async def dashboard(token:AuthToken, *args, **kwargs):
+                # your function
+            ```
+        """
+        session_token = self.session_token
+        session_expiry = self.session_expiry
+        session_refresh = self.session_refresh
+        session_rd = self.session_rd
+        app_login_redirect = self.app_login_redirect
+        check = self._check_token_cached
+        construct = self._constructAuthToken
+        return_path = self._return_path
+        refresh_token = self._refresh_token
+        @wraps(route_function)
+        async def decorator(*args, **kwargs):
+            thetoken = session.get(session_token)
+            expiry = session.get(session_expiry)
+            if thetoken and check(thetoken, expiry):
+                token = thetoken
+                refresh = session.get(session_refresh)
+                if expiry and refresh:
+                    token = construct(token, expiry, refresh)
+                elif refresh:
+                    try:
+                        token = await refresh_token(refresh)
+                    except Exception:
+                        session[session_rd] = return_path()
+                        return redirect(app_login_redirect)
+                return await route_function(token, *args, **kwargs)
+            else:
+                session[session_rd] = return_path()
+                return redirect(app_login_redirect)
         return decorator
     
     def autologout(self, route_function):
@@ -243,16 +530,19 @@ class FlaskIntegration:
                 return redirect(url_for('home'))
             ```
         """
+        session_token = self.session_token
+        session_expiry = self.session_expiry
+        session_refresh = self.session_refresh
+        session_rd = self.session_rd
+        token_cache = self._token_cache
+        revoke = self._revoke_in_background
         @wraps(route_function)
         def decorator(*args, **kwargs):
-            ot = session.pop(self.session_token, None)
-            session.pop(self.session_expiry, None)
-            session.pop(self.session_refresh, None)
-            session.pop(self.session_rd, None)
+            ot = session.get(session_token)
+            for key in (session_token, session_expiry, session_refresh, session_rd):
+                session.pop(key, None)
             if ot:
-                try:
-                    concurrent.futures.ThreadPoolExecutor().submit(lambda: self.cbsync.revoke_token(ot)).result()
-                except:
-                    pass
+                token_cache.pop(ot, None)
+                revoke(ot)
             return route_function(*args, **kwargs)
         return decorator
\ No newline at end of file